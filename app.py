@@ -4,13 +4,23 @@ Backend Logic (Flask)
 Fixed: Karte Reuse (Copy) Functionality
 """
 import os
+import hmac
 import json
-from datetime import datetime
+import math
+from datetime import date, datetime
+from itertools import groupby
+from operator import itemgetter
 from typing import Optional, Dict, Any, List, Union
 
-from flask import Flask, render_template, request, redirect, url_for, abort, flash, session
+from flask import Flask, render_template, request, redirect, url_for, abort, flash, session, g
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_caching import Cache
+from flask_session import Session
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import check_password_hash
+import redis
 from dotenv import load_dotenv
 
 from database import DatabaseManager
@@ -18,13 +28,33 @@ from database import DatabaseManager
 load_dotenv()
 
 app = Flask(__name__)
+# PaaS のルーター越しに受けるため、remote_addr を X-Forwarded-For（ルーター1段分）から取る
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default_secret_key_for_local_test')
 COACH_SHARED_PASSWORD = os.environ.get('COACH_PASSWORD', 'pirates')
 
+# REDIS_URL がある場合はサーバーサイドセッション（Cookie にはセッションIDのみ）
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(REDIS_URL)
+    Session(app)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# ワーカー間で共有できる Redis があればそれを使う。無ければワーカー毎の SimpleCache のため、
+# 他ワーカーでの削除・権限変更が届くまでの猶予として認証情報のキャッシュ時間を短くする
+if REDIS_URL:
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': REDIS_URL})
+    USER_CACHE_TTL = 300
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+    USER_CACHE_TTL = 5
+# 試行回数はワーカー間で共有しないと上限がワーカー数倍になるため、Redis があればそちらに保存する
+limiter = Limiter(get_remote_address, app=app, storage_uri=REDIS_URL or 'memory://')
+
 db_manager = DatabaseManager()
 
 class Const:
@@ -52,6 +82,12 @@ PULLDOWN_OPTIONS = {
 
 TIME_LOSS_OPTIONS = [Const.TL_NONE, Const.TL_NEW, Const.TL_LOSS, Const.TL_RTP]
 PARTICIPATION_STATUS_OPTIONS = [Const.STATUS_IN, Const.STATUS_RESTRICTION, Const.STATUS_OUT, Const.STATUS_GTD]
+_PULLDOWN_KEYS = tuple(PULLDOWN_OPTIONS)
+_KARTE_STR_FIELDS = ('date', 'tr', 'time_loss_category', 's_content', 'o_content', 'a_content', 'p_content',
+                     'injury_name', 'participation_status', 'return_est', 'progress_note')
+_KARTE_FORM_FIELDS = ('player_id',) + _KARTE_STR_FIELDS + _PULLDOWN_KEYS
+KARTE_PER_PAGE = 50
+_COACH_PRIORITY_MAP = {Const.STATUS_OUT: 1, Const.STATUS_GTD: 2, Const.STATUS_RESTRICTION: 3, Const.STATUS_IN: 4}
 
 class User(UserMixin):
     def __init__(self, user_id, username, is_admin):
@@ -59,33 +95,45 @@ class User(UserMixin):
         self.username = username
         self.is_admin = is_admin
 
+@cache.memoize(timeout=USER_CACHE_TTL)
+def _fetch_user_row(user_id):
+    """ユーザー行(dict)をキャッシュ付きで取得。キーは文字列の user_id"""
+    return db_manager._execute("SELECT user_id, username, is_admin FROM USER_MASTER WHERE user_id = %s", (user_id,))
+
 @login_manager.user_loader
 def load_user(user_id):
-    user_data = db_manager._execute("SELECT user_id, username, is_admin FROM USER_MASTER WHERE user_id = %s", (user_id,))
+    user_data = _fetch_user_row(str(user_id))
     if user_data: 
         return User(user_data['user_id'], user_data['username'], user_data['is_admin'])
     return None
 
+def players_cached():
+    """選手一覧をリクエスト内で1回だけ取得（プロセス内の TTL キャッシュは DatabaseManager 側）"""
+    if not hasattr(g, '_players'): g._players = db_manager.get_players()
+    return g._players
+
+def _build_report_context():
+    """レポート画面の描画用データ（集計結果とグラフ用JSON）を生成"""
+    # 集計・並び替えは SQL 側で実施済み（カテゴリ順 → 件数降順）
+    site_totals = db_manager.get_site_totals()
+    return {
+        'tl_counts': db_manager.get_all_time_loss_categories(),
+        'grouped_data': {cat: list(items) for cat, items in groupby(db_manager.get_injury_report_data(), key=itemgetter('time_loss_category'))},
+        'chart_labels': json.dumps([x['injury_site'] for x in site_totals]),
+        'chart_values': json.dumps([x['total'] for x in site_totals]),
+    }
+
+def today_str():
+    """当日の日付文字列（YYYY-MM-DD）をリクエスト内で1回だけ生成"""
+    if not hasattr(g, '_today'): g._today = datetime.now().strftime('%Y-%m-%d')
+    return g._today
+
 def prepare_karte_data(form_data: Dict[str, Any]) -> Dict[str, Any]:
     """フォーム入力をDB保存用形式に変換"""
-    data = {
-        'date': form_data.get('date'),
-        'player_id': form_data.get('player_id') if form_data.get('player_id') else None,
-        'tr': form_data.get('tr', ''),
-        'time_loss_category': form_data.get('time_loss_category'),
-        'diagnosis_flag': 1 if form_data.get('diagnosis_flag') == 'on' else 0,
-        's_content': form_data.get('s_content'),
-        'o_content': form_data.get('o_content'),
-        'a_content': form_data.get('a_content'),
-        'p_content': form_data.get('p_content'),
-        'report_flag': 1 if form_data.get('report_flag') == 'on' else 0,
-        'injury_name': form_data.get('injury_name', ''),
-        'participation_status': form_data.get('participation_status', ''),
-        'return_est': form_data.get('return_est', ''),
-        'progress_note': form_data.get('progress_note', '')
-    }
-    for key in PULLDOWN_OPTIONS.keys():
-        data[key] = form_data.get(key, '')
+    # 空欄は None（NULL 保存）に寄せる
+    data = {k: form_data.get(k) or None for k in _KARTE_FORM_FIELDS}
+    data['diagnosis_flag'] = 1 if form_data.get('diagnosis_flag') == 'on' else 0
+    data['report_flag'] = 1 if form_data.get('report_flag') == 'on' else 0
     return data
 
 # --- ルート設定 ---
@@ -105,8 +153,9 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
-        user_data = db_manager._execute("SELECT * FROM USER_MASTER WHERE username = %s", (username,))
+        user_data = db_manager._execute("SELECT user_id, username, password_hash, is_admin FROM USER_MASTER WHERE username = %s LIMIT 1", (username,))
         if user_data and check_password_hash(user_data['password_hash'], password):
+            cache.delete_memoized(_fetch_user_row, str(user_data['user_id']))
             login_user(User(user_data['user_id'], user_data['username'], user_data['is_admin']))
             return redirect(url_for('index'))
         flash('ログイン失敗', 'danger')
@@ -119,10 +168,12 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/coach_login', methods=['GET', 'POST'])
+# 失敗（フォーム再表示 = 200）だけを数え、ログイン成功（リダイレクト）は回数に含めない
+@limiter.limit("5/minute", methods=['POST'], deduct_when=lambda response: response.status_code == 200)
 def coach_login():
     if session.get('coach_authenticated'): return redirect(url_for('coach_view'))
     if request.method == 'POST':
-        if request.form.get('password') == COACH_SHARED_PASSWORD:
+        if hmac.compare_digest(request.form.get('password', '').encode(), COACH_SHARED_PASSWORD.encode()):
             session['coach_authenticated'] = True
             return redirect(url_for('coach_view'))
         flash('合言葉が違います', 'danger')
@@ -134,23 +185,22 @@ def coach_view():
         return redirect(url_for('coach_login'))
     
     reports = db_manager.get_coach_reports()
-    priority_map = {Const.STATUS_OUT: 1, Const.STATUS_GTD: 2, Const.STATUS_RESTRICTION: 3, Const.STATUS_IN: 4}
-    
     if reports:
+        injury_dates = db_manager.get_latest_injury_dates_bulk([(r.get('player_id'), r.get('date')) for r in reports])
         for row in reports:
             p_id = row.get('player_id')
             c_date = row.get('date')
-            injury_date_str = db_manager.get_latest_injury_date(p_id, c_date)
+            injury_date_str = injury_dates.get((p_id, c_date))
             if injury_date_str:
-                inj_dt = datetime.strptime(injury_date_str, '%Y-%m-%d')
-                cur_dt = datetime.strptime(c_date, '%Y-%m-%d')
-                diff = (cur_dt - inj_dt).days
-                row['elapsed_days'] = f"Day {diff} (W{diff//7 + 1}D{diff%7})"
+                diff = date.fromisoformat(c_date).toordinal() - date.fromisoformat(injury_date_str).toordinal()
+                weeks, days = divmod(diff, 7)
+                row['elapsed_days'] = f"Day {diff} (W{weeks + 1}D{days})"
             else:
                 row['elapsed_days'] = "-"
-        reports.sort(key=lambda x: priority_map.get(x.get('participation_status'), 99))
+            row['_prio'] = _COACH_PRIORITY_MAP.get(row.get('participation_status'), 99)
+        reports.sort(key=itemgetter('_prio'))
     
-    return render_template('coach_view.html', reports=reports, today=datetime.now().strftime('%Y-%m-%d'))
+    return render_template('coach_view.html', reports=reports, today=today_str())
 
 @app.route('/')
 @login_required
@@ -162,9 +212,11 @@ def index():
         'keyword': request.args.get('keyword'),
         'time_loss_category': request.args.get('time_loss_category')
     }
-    data = db_manager.search_karty(filters)
-    return render_template('index.html', data=data, player_list=db_manager.get_players(), 
-                           filters=filters, TIME_LOSS_OPTIONS=TIME_LOSS_OPTIONS)
+    page = max(request.args.get('page', 1, type=int), 1)
+    data, total = db_manager.search_karty(filters, page, KARTE_PER_PAGE)
+    return render_template('index.html', data=data, player_list=players_cached(), 
+                           filters=filters, TIME_LOSS_OPTIONS=TIME_LOSS_OPTIONS,
+                           page=page, pages=max(math.ceil(total / KARTE_PER_PAGE), 1), total=total)
 
 @app.route('/create_karte', methods=['GET', 'POST'])
 @login_required
@@ -173,33 +225,28 @@ def create_karte():
         data = prepare_karte_data(request.form)
         if not data.get('player_id'):
             flash('エラー: 選手を選択してください。', 'danger')
-            return render_template('karte_form.html', player_list=db_manager.get_players(),
+            return render_template('karte_form.html', player_list=players_cached(),
                                    PULLDOWN_OPTIONS=PULLDOWN_OPTIONS, TIME_LOSS_OPTIONS=TIME_LOSS_OPTIONS,
                                    PARTICIPATION_STATUS_OPTIONS=PARTICIPATION_STATUS_OPTIONS,
-                                   karte=data, action='create', today=datetime.now().strftime('%Y-%m-%d'))
+                                   karte=data, action='create', today=today_str())
         
         db_manager.create_karte(data)
         flash('カルテを作成しました', 'success')
         return redirect(url_for('index'))
     
     # 再利用作成（コピー）の処理
-    copied_karte = None
-    copy_from_id = request.args.get('copy_from_id')
-    copy_player_id = request.args.get('copy_player_id')
-
-    if copy_from_id:
-        copied_karte = db_manager.get_karte(copy_from_id)
-    elif copy_player_id:
-        copied_karte = db_manager.get_latest_karte_by_player(copy_player_id)
+    copy_from_id = request.args.get('copy_from_id') or None
+    copy_player_id = request.args.get('copy_player_id') or None
+    copied_karte = db_manager.get_copy_source(copy_from_id, copy_player_id) if copy_from_id or copy_player_id else None
     
     if copied_karte:
-        copied_karte['date'] = datetime.now().strftime('%Y-%m-%d')
+        copied_karte['date'] = today_str()
         copied_karte['karte_id'] = None # IDを消去して新規扱いにする
 
-    return render_template('karte_form.html', player_list=db_manager.get_players(),
+    return render_template('karte_form.html', player_list=players_cached(),
                            PULLDOWN_OPTIONS=PULLDOWN_OPTIONS, TIME_LOSS_OPTIONS=TIME_LOSS_OPTIONS,
                            PARTICIPATION_STATUS_OPTIONS=PARTICIPATION_STATUS_OPTIONS,
-                           karte=copied_karte, action='create', today=datetime.now().strftime('%Y-%m-%d'))
+                           karte=copied_karte, action='create', today=today_str())
 
 @app.route('/karte/<int:karte_id>', methods=['GET', 'POST'])
 @login_required
@@ -211,7 +258,7 @@ def edit_karte(karte_id):
         flash('カルテを更新しました', 'success')
         return redirect(url_for('edit_karte', karte_id=karte_id))
     
-    return render_template('karte_form.html', karte=karte, player_list=db_manager.get_players(),
+    return render_template('karte_form.html', karte=karte, player_list=players_cached(),
                            PULLDOWN_OPTIONS=PULLDOWN_OPTIONS, TIME_LOSS_OPTIONS=TIME_LOSS_OPTIONS,
                            PARTICIPATION_STATUS_OPTIONS=PARTICIPATION_STATUS_OPTIONS, action='edit')
 
@@ -226,20 +273,7 @@ def delete_karte(karte_id):
 @app.route('/report')
 @login_required
 def report():
-    report_data = db_manager.get_injury_report_data()
-    site_summary = {}
-    for item in report_data:
-        site = item.get('injury_site', '不明')
-        site_summary[site] = site_summary.get(site, 0) + item.get('count', 0)
-    sorted_sites = sorted(site_summary.items(), key=lambda x: x[1], reverse=True)
-    grouped_data = {}
-    for item in report_data:
-        cat = item.get('time_loss_category', 'OTHER')
-        if cat not in grouped_data: grouped_data[cat] = []
-        grouped_data[cat].append(item)
-    return render_template('report.html', tl_counts=db_manager.get_all_time_loss_categories(), grouped_data=grouped_data,
-                           chart_labels=json.dumps([x[0] for x in sorted_sites]),
-                           chart_values=json.dumps([x[1] for x in sorted_sites]))
+    return render_template('report.html', **_build_report_context())
 
 @app.route('/players', methods=['GET', 'POST'])
 @login_required
@@ -248,12 +282,13 @@ def player_master():
         name = request.form.get('player_name', '').strip()
         if name and db_manager.add_player(name): flash(f'選手 {name} を登録しました', 'success')
         return redirect(url_for('player_master'))
-    return render_template('player_master.html', players=db_manager.get_players())
+    return render_template('player_master.html', players=players_cached())
 
 @app.route('/players/edit/<int:player_id>', methods=['POST'])
 @login_required
 def edit_player(player_id):
-    if request.form.get('action') == 'delete': db_manager.delete_player(player_id)
+    if request.form.get('action') == 'delete':
+        db_manager.delete_player(player_id)
     else:
         new_name = request.form.get('player_name', '').strip()
         if new_name: db_manager.update_player_name(player_id, new_name)
@@ -265,8 +300,13 @@ def user_master():
     if not current_user.is_admin: abort(403)
     if request.method == 'POST':
         action = request.form.get('action')
-        if action == 'add': db_manager.add_user(request.form.get('username'), request.form.get('password'), 1 if request.form.get('is_admin') else 0)
-        elif action == 'delete': db_manager.delete_user(request.form.get('user_id'))
+        if action == 'add':
+            if not db_manager.add_user(request.form.get('username'), request.form.get('password'), 1 if request.form.get('is_admin') else 0):
+                flash('ユーザーを登録できませんでした（未入力または重複）', 'danger')
+            cache.delete_memoized(_fetch_user_row)
+        elif action == 'delete':
+            db_manager.delete_user(request.form.get('user_id'))
+            cache.delete_memoized(_fetch_user_row, str(request.form.get('user_id')))
         return redirect(url_for('user_master'))
     return render_template('user_master.html', users=db_manager.get_users())
 
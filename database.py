@@ -3,46 +3,159 @@ Pirates Trainer App - Database Manager
 Handles all PostgreSQL interactions.
 """
 import os
+import time
+import threading
 import logging
 import psycopg2
+import redis
+from contextlib import contextmanager
+from functools import lru_cache
+from psycopg2.errors import DuplicatePreparedStatement, InvalidSqlStatementName, UniqueViolation
+from psycopg2.extensions import connection as PgConnection
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from cachetools import TTLCache
 from werkzeug.security import generate_password_hash
 from typing import List, Dict, Any, Optional, Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 接続ごとに PREPARE した文を使い回すため、DATABASE_URL は直結（非プーラー）のエンドポイントを指すこと
+# （pgbouncer のトランザクションモード、例: Neon の -pooler では別のバックエンドに振られ文が見えない）
 DB_URL = os.environ.get('DATABASE_URL', None)
+# getconn は空きが無いと待たずに PoolError を送出するため、1ワーカーのスレッド数（gunicorn.conf.py の threads）以上を確保する。
+# 全体ではワーカー数 × DB_POOL_MAX が DB の max_connections に収まるよう WEB_CONCURRENCY と合わせて設定すること
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+DB_POOL_MAX = max(int(os.environ.get('DB_POOL_MAX', 10)), GUNICORN_THREADS)
+REDIS_URL = os.environ.get('REDIS_URL')
+# クエリキャッシュはワーカー毎。Redis があれば世代番号で他ワーカーの書き込みも検知できるが、無い場合は TTL を短くする
+QUERY_CACHE_TTL = 30 if REDIS_URL else 5
+CACHE_GEN_KEY = 'athlete:db_cache_gen'
+# プール接続が NAT/アイドル切断で黙って死なないよう TCP keepalive を有効化
+DB_CONNECT_KWARGS = dict(sslmode='require', keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3, tcp_user_timeout=10000, connect_timeout=5)
+# この秒数以上アイドルだった接続は、貸し出し前に SELECT 1 で生存確認する
+POOL_IDLE_CHECK = 60
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+# カルテの書き込み列（固定順）。作成・更新はこの順で PREPARE 済みの文を使う
+KARTE_COLUMNS = ('date', 'player_id', 'tr', 'time_loss_category', 'diagnosis_flag', 's_content', 'o_content', 'a_content', 'p_content',
+                 'report_flag', 'injury_name', 'participation_status', 'return_est', 'progress_note',
+                 'activity', 'timing', 'age', 'status', 'mechanism', 'injury_type', 'injury_site', 'position', 'onset_style')
+_KARTE_SELECT_COLS = ', '.join(f'k.{col}' for col in ('karte_id',) + KARTE_COLUMNS)
+
+# 接続ごとに PREPARE して使い回す文。SELECT は列を明示し、列追加のマイグレーション後も結果型が変わらないようにする
+PREPARED_SQL = {
+    'karte_ins': f"INSERT INTO KARTY_DATA ({', '.join(KARTE_COLUMNS)}) VALUES ({', '.join(f'${i}' for i in range(1, len(KARTE_COLUMNS) + 1))}) RETURNING karte_id",
+    'karte_upd': f"UPDATE KARTY_DATA SET {', '.join(f'{col} = ${i}' for i, col in enumerate(KARTE_COLUMNS, 1))} WHERE karte_id = ${len(KARTE_COLUMNS) + 1}",
+    'karte_del': "DELETE FROM KARTY_DATA WHERE karte_id = $1",
+    'karte_get': f"SELECT {_KARTE_SELECT_COLS} FROM KARTY_DATA k WHERE k.karte_id = $1",
+    'player_get': "SELECT player_id, player_name FROM PLAYER_MASTER WHERE player_id = $1",
+}
+
+PLAYERS_SQL = "SELECT player_id, player_name FROM PLAYER_MASTER ORDER BY player_name"
+
+# キーワード検索対象（S/O/A/P/TR）の連結式。GIN トライグラム索引と検索クエリで同一の式を使う
+KARTE_SEARCH_EXPR = "(coalesce(s_content, '') || ' ' || coalesce(o_content, '') || ' ' || coalesce(a_content, '') || ' ' || coalesce(p_content, '') || ' ' || coalesce(tr, ''))"
+
+# search_karty の絞り込み句。指定された条件の組み合わせ（shape）ごとに SQL を組み立ててキャッシュする
+_SEARCH_CLAUSES = {
+    'player_id': " AND k.player_id = %s",
+    'start_date': " AND k.date >= %s",
+    'end_date': " AND k.date <= %s",
+    'time_loss_only': " AND (k.time_loss_category = 'TIME LOSS' OR k.time_loss_category = 'RETURN TO PLAY')",
+    'time_loss_category': " AND k.time_loss_category = %s",
+    'keyword': f" AND {KARTE_SEARCH_EXPR} ILIKE %s",
+}
+
+@lru_cache(maxsize=64)
+def _search_sql(shape: tuple):
+    """(件数SQL, 一覧SQL) を返す。一覧は表示に必要な列だけ（A欄は先頭のみ）"""
+    where = " WHERE 1=1" + ''.join(_SEARCH_CLAUSES[key] for key in shape)
+    return ("SELECT COUNT(*) AS total FROM KARTY_DATA k" + where,
+            "SELECT k.karte_id, k.date, k.player_id, k.tr, LEFT(k.a_content, 12) AS a_content, k.time_loss_category FROM KARTY_DATA k" + where + " ORDER BY k.date DESC LIMIT %s OFFSET %s")
+
+class PreparedConnection(PgConnection):
+    """プール用の接続。このセッションで PREPARE 済みの文の名前と最終利用時刻を保持する"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+    def is_alive(self) -> bool:
+        try:
+            with self.cursor() as c: c.execute("SELECT 1")
+            self.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+class LazyConnectionPool(ThreadedConnectionPool):
+    """起動時には接続せず、必要になった時点で張る。返却された接続は maxconn 本まで保持する
+    （標準のプールは minconn 本を超えた返却分を close してしまうため）"""
+    def __init__(self, maxconn, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
 
 class DatabaseManager:
     _instance = None
+    _lock = threading.Lock()
     
     def __new__(cls):
+        # ダブルチェックロッキング: 生成済みならロックを取らずに返す
         if cls._instance is None:
-            cls._instance = super(DatabaseManager, cls).__new__(cls)
-            cls._instance._initialized = False
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(DatabaseManager, cls).__new__(cls)
+                    cls._instance._initialized = False
         return cls._instance
 
     def __init__(self):
         if self._initialized: return
-        if DB_URL:
-            self._initialize_db()
-            self._initialized = True
+        with self._lock:
+            if self._initialized: return
+            self._cache = TTLCache(maxsize=512, ttl=QUERY_CACHE_TTL)
+            self._cache_lock = threading.Lock()
+            # 破棄のたびに進める世代番号。問い合わせ中に破棄された結果は書き戻さない
+            self._cache_gen = 0
+            self._redis = redis.from_url(REDIS_URL) if REDIS_URL else None
+            self._shared_gen = None
+            if DB_URL:
+                self._pool = LazyConnectionPool(DB_POOL_MAX, DB_URL, connection_factory=PreparedConnection, **DB_CONNECT_KWARGS)
+                self._initialize_db()
+                self._initialized = True
 
+    @contextmanager
     def _connect(self):
-        return psycopg2.connect(DB_URL, sslmode='require')
+        """プールから接続を借り、commit/rollback してから返却する（close はしない）"""
+        conn = self._pool.getconn()
+        if conn.closed or (time.monotonic() - conn.last_used >= POOL_IDLE_CHECK and not conn.is_alive()):
+            # 切断済み・応答のない接続は破棄して取り直す
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed: conn.rollback()
+            raise
+        finally:
+            conn.last_used = time.monotonic()
+            self._pool.putconn(conn, close=bool(conn.closed))
 
     def _initialize_db(self):
+        """テーブル作成と admin の存在確認を1往復にまとめ、admin 未登録時のみパスワードハッシュを計算する"""
+        ddl = ";\n".join([
+            "CREATE TABLE IF NOT EXISTS USER_MASTER (user_id SERIAL PRIMARY KEY, username TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL, is_admin INTEGER NOT NULL DEFAULT 0)",
+            "CREATE TABLE IF NOT EXISTS PLAYER_MASTER (player_id SERIAL PRIMARY KEY, player_name TEXT NOT NULL UNIQUE)",
+            "CREATE TABLE IF NOT EXISTS KARTY_DATA (karte_id SERIAL PRIMARY KEY, player_id INTEGER, date TEXT NOT NULL, tr TEXT, time_loss TEXT, time_loss_category TEXT, diagnosis_flag INTEGER DEFAULT 0, s_content TEXT, o_content TEXT, a_content TEXT, p_content TEXT, activity TEXT, timing TEXT, age TEXT, status TEXT, mechanism TEXT, injury_type TEXT, injury_site TEXT, position TEXT, onset_style TEXT, FOREIGN KEY (player_id) REFERENCES PLAYER_MASTER(player_id))",
+            "SELECT 1 FROM USER_MASTER WHERE username = 'admin'"
+        ])
         try:
             with self._connect() as conn:
                 with conn.cursor() as c:
-                    c.execute("CREATE TABLE IF NOT EXISTS USER_MASTER (user_id SERIAL PRIMARY KEY, username TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL, is_admin INTEGER NOT NULL DEFAULT 0)")
-                    c.execute("CREATE TABLE IF NOT EXISTS PLAYER_MASTER (player_id SERIAL PRIMARY KEY, player_name TEXT NOT NULL UNIQUE)")
-                    c.execute("CREATE TABLE IF NOT EXISTS KARTY_DATA (karte_id SERIAL PRIMARY KEY, player_id INTEGER, date TEXT NOT NULL, tr TEXT, time_loss TEXT, time_loss_category TEXT, diagnosis_flag INTEGER DEFAULT 0, s_content TEXT, o_content TEXT, a_content TEXT, p_content TEXT, activity TEXT, timing TEXT, age TEXT, status TEXT, mechanism TEXT, injury_type TEXT, injury_site TEXT, position TEXT, onset_style TEXT, FOREIGN KEY (player_id) REFERENCES PLAYER_MASTER(player_id))")
-                    c.execute("SELECT user_id FROM USER_MASTER WHERE username = 'admin'")
-                    if c.fetchone() is None:
-                        c.execute("INSERT INTO USER_MASTER (username, password_hash, is_admin) VALUES (%s, %s, %s)", ('admin', generate_password_hash('password'), 1))
-                conn.commit()
+                    c.execute(ddl)
+                    # 既存環境ではハッシュ計算（scrypt）を丸ごと省く
+                    if c.fetchone() is None: c.execute("INSERT INTO USER_MASTER (username, password_hash, is_admin) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING", ('admin', generate_password_hash('password', method=PASSWORD_HASH_METHOD), 1))
         except Exception as e: logger.error(f"DB初期化エラー: {e}")
 
     def migrate_schema(self) -> bool:
@@ -51,116 +164,242 @@ class DatabaseManager:
             "ALTER TABLE KARTY_DATA ADD COLUMN IF NOT EXISTS injury_name TEXT",
             "ALTER TABLE KARTY_DATA ADD COLUMN IF NOT EXISTS participation_status TEXT",
             "ALTER TABLE KARTY_DATA ADD COLUMN IF NOT EXISTS return_est TEXT",
-            "ALTER TABLE KARTY_DATA ADD COLUMN IF NOT EXISTS progress_note TEXT"
+            "ALTER TABLE KARTY_DATA ADD COLUMN IF NOT EXISTS progress_note TEXT",
+            "CREATE INDEX IF NOT EXISTS idx_karty_player_date_id ON KARTY_DATA (player_id, date DESC, karte_id DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_karty_injury ON KARTY_DATA (player_id, date DESC) WHERE time_loss_category = 'NEW/RE-INJURY'",
+            "CREATE INDEX IF NOT EXISTS idx_karty_tlc ON KARTY_DATA (time_loss_category)",
+            "CREATE INDEX IF NOT EXISTS idx_karty_report ON KARTY_DATA (player_id, date DESC, karte_id DESC) WHERE report_flag = 1",
+            "CREATE INDEX IF NOT EXISTS idx_karty_date ON KARTY_DATA (date)"
         ]
         try:
             with self._connect() as conn:
-                with conn.cursor() as c:
-                    for sql in statements: c.execute(sql)
-                conn.commit()
-            return True
+                with conn.cursor() as c: c.execute(";\n".join(statements))
         except Exception as e:
             logger.error(f"スキーマ更新エラー: {e}")
             return False
+        # pg_trgm は権限・contrib の有無で失敗しうるため別トランザクションにし、失敗しても必須の変更は巻き戻さない
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as c: c.execute(f"CREATE EXTENSION IF NOT EXISTS pg_trgm;\nCREATE INDEX IF NOT EXISTS idx_karty_sopa_trgm ON KARTY_DATA USING gin ({KARTE_SEARCH_EXPR} gin_trgm_ops)")
+        except Exception as e: logger.warning(f"トライグラム索引の作成をスキップ: {e}")
+        return True
+
+    def _query(self, query: str, params: tuple = None, fetch_all: bool = False):
+        """_execute の本体。DB エラーは呼び出し側へ送出する"""
+        with self._connect() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as c:
+                c.execute(query, params or ())
+                if fetch_all: return [dict(row) for row in c.fetchall()]
+                res = c.fetchone()
+                return dict(res) if res else None
+
+    def _query_json(self, query: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        """結果全体を Postgres 側で json_agg して1値で受け取る（行ごとの RealDictRow→dict 変換を省く）"""
+        res = self._query(f"SELECT COALESCE(json_agg(t), '[]'::json) AS rows FROM ({query}) t", params)
+        return res['rows'] if res else []
 
     def _execute(self, query: str, params: tuple = None, fetch_all: bool = False):
+        try: return self._query(query, params, fetch_all)
+        except Exception as e:
+            logger.error(f"SQL実行エラー: {e}")
+            return [] if fetch_all else None
+
+    def _execute_json(self, query: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        try: return self._query_json(query, params)
+        except Exception as e:
+            logger.error(f"SQL実行エラー: {e}")
+            return []
+
+    def _fetch_prepared(self, name: str, params: List[Any]):
         try:
             with self._connect() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as c:
-                    c.execute(query, params or ())
-                    if fetch_all: return [dict(row) for row in c.fetchall()]
+                    self._execute_prepared(c, name, params)
                     res = c.fetchone()
                     return dict(res) if res else None
         except Exception as e:
             logger.error(f"SQL実行エラー: {e}")
-            return [] if fetch_all else None
+            return None
 
-    def _sanitize_values(self, data: Dict[str, Any]) -> List[Any]:
-        return [v if v != '' else None for v in data.values()]
+    def _write(self, statements: List[tuple]):
+        """(SQL, params) の列を1トランザクションで実行。複数文は1つの execute にまとめて1往復で送る"""
+        sql = '; '.join(stmt for stmt, _ in statements)
+        params = [p for _, stmt_params in statements for p in stmt_params]
+        with self._connect() as conn:
+            with conn.cursor() as c: c.execute(sql, params)
+        self._invalidate_cache()
+
+    def _execute_prepared(self, c, name: str, params: List[Any]):
+        """PREPARED_SQL[name] を接続ごとに初回のみ PREPARE し、以降は EXECUTE で実行（解析・計画を省く）。
+        サーバー側の文が消えていた／重複していた場合は DEALLOCATE ALL して1回だけやり直す。
+        やり直し時に rollback するため、トランザクションの最初の文として呼ぶこと"""
+        try:
+            self._prepare_and_execute(c, name, params)
+        except (InvalidSqlStatementName, DuplicatePreparedStatement):
+            c.connection.rollback()
+            c.execute("DEALLOCATE ALL")
+            c.connection.prepared.clear()
+            self._prepare_and_execute(c, name, params)
+
+    def _prepare_and_execute(self, c, name: str, params: List[Any]):
+        if name not in c.connection.prepared:
+            c.execute(f"PREPARE {name} AS {PREPARED_SQL[name]}")
+            c.connection.prepared.add(name)
+        c.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    def _execute_cached(self, query: str, params: tuple = (), fetch_all: bool = False, as_json: bool = False):
+        """更新頻度の低い読み取り用。(SQL, params) をキーに TTL キャッシュし、書き込み時に全破棄する（エラー時の空結果はキャッシュしない）"""
+        if not self._sync_cache(): return self._execute_json(query, params) if as_json else self._execute(query, params, fetch_all)
+        key = (query, params, fetch_all, as_json)
+        with self._cache_lock:
+            if key in self._cache: return self._cache[key]
+            gen = self._cache_gen
+        try: res = self._query_json(query, params) if as_json else self._query(query, params, fetch_all)
+        except Exception as e:
+            logger.error(f"SQL実行エラー: {e}")
+            return [] if fetch_all or as_json else None
+        self._cache_store(key, gen, res)
+        return res
+
+    def _cache_store(self, key, gen: int, value):
+        """問い合わせ開始時の世代 gen から破棄されていなければ value をキャッシュする"""
+        with self._cache_lock:
+            if gen == self._cache_gen: self._cache[key] = value
+
+    def _sync_cache(self) -> bool:
+        """Redis の共有世代番号が進んでいれば（他ワーカーで書き込みがあれば）ローカルのキャッシュを破棄する。Redis に届かない間は False（キャッシュを使わない）"""
+        if self._redis is None: return True
+        try: shared = self._redis.get(CACHE_GEN_KEY)
+        except redis.RedisError as e:
+            logger.warning(f"キャッシュ世代の取得エラー: {e}")
+            return False
+        with self._cache_lock:
+            if shared != self._shared_gen:
+                self._shared_gen = shared
+                self._cache.clear()
+                self._cache_gen += 1
+        return True
+
+    def _invalidate_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_gen += 1
+        if self._redis is not None:
+            try: self._redis.incr(CACHE_GEN_KEY)
+            except redis.RedisError as e: logger.warning(f"キャッシュ世代の更新エラー: {e}")
 
     def get_users(self): return self._execute("SELECT user_id, username, is_admin FROM USER_MASTER ORDER BY user_id", fetch_all=True)
     def add_user(self, un, pw, ad):
+        """重複ユーザー名は ON CONFLICT で弾き、例外を経由せず False を返す"""
+        if not un or not pw: return False
         try:
             with self._connect() as conn:
-                with conn.cursor() as c: c.execute("INSERT INTO USER_MASTER (username, password_hash, is_admin) VALUES (%s, %s, %s)", (un, generate_password_hash(pw), ad))
-                conn.commit()
-            return True
-        except: return False
-    def delete_user(self, uid):
-        with self._connect() as conn:
-            with conn.cursor() as c: c.execute("DELETE FROM USER_MASTER WHERE user_id = %s", (uid,))
-            conn.commit()
+                with conn.cursor() as c:
+                    c.execute("INSERT INTO USER_MASTER (username, password_hash, is_admin) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING RETURNING user_id", (un, generate_password_hash(pw, method=PASSWORD_HASH_METHOD), ad))
+                    res = c.fetchone()
+        except psycopg2.Error as e:
+            logger.error(f"ユーザー登録エラー: {e}")
+            return False
+        return res[0] if res else False
+    def delete_user(self, uid): self._write([("DELETE FROM USER_MASTER WHERE user_id = %s", (uid,))])
 
-    def get_players(self): return self._execute('SELECT player_id, player_name FROM PLAYER_MASTER ORDER BY player_name', fetch_all=True)
-    def get_player(self, pid): return self._execute("SELECT player_id, player_name FROM PLAYER_MASTER WHERE player_id = %s", (pid,))
+    def get_players(self): return self._execute_cached(PLAYERS_SQL, fetch_all=True)
+    def get_player_names(self, refresh: bool = False) -> Dict[int, str]:
+        """player_id → 選手名。get_players と同じキャッシュに載せ、選手マスタ更新時に破棄される。refresh=True ではキャッシュを通さず取り直す"""
+        if not self._sync_cache(): return {p['player_id']: p['player_name'] for p in self.get_players()}
+        with self._cache_lock: names, gen = (None if refresh else self._cache.get('player_names')), self._cache_gen
+        if names is None:
+            players = self._execute(PLAYERS_SQL, fetch_all=True) if refresh else self.get_players()
+            names = {p['player_id']: p['player_name'] for p in players}
+            # _execute / get_players はエラー時に [] を返すため、空のマップはキャッシュしない
+            if names: self._cache_store('player_names', gen, names)
+        return names
+    def _attach_player_names(self, rows: List[Dict[str, Any]]):
+        """各行に player_name を付与。マップに無い player_id があれば（他ワーカーで追加された直後など）1回だけ取り直す"""
+        names = self.get_player_names()
+        if any(r['player_id'] not in names for r in rows if r['player_id'] is not None): names = self.get_player_names(refresh=True)
+        for r in rows: r['player_name'] = names.get(r['player_id'])
+    def get_player(self, pid): return self._fetch_prepared('player_get', [pid])
     def add_player(self, name):
+        if not name: return False
         try:
             with self._connect() as conn:
-                with conn.cursor() as c: c.execute("INSERT INTO PLAYER_MASTER (player_name) VALUES (%s)", (name,))
-                conn.commit()
-            return True
-        except: return False
+                with conn.cursor() as c:
+                    c.execute("INSERT INTO PLAYER_MASTER (player_name) VALUES (%s) ON CONFLICT (player_name) DO NOTHING RETURNING player_id", (name,))
+                    res = c.fetchone()
+        except psycopg2.Error as e:
+            logger.error(f"選手登録エラー: {e}")
+            return False
+        if not res: return False
+        self._invalidate_cache()
+        return res[0]
     def update_player_name(self, pid, name):
         try:
-            with self._connect() as conn:
-                with conn.cursor() as c: c.execute("UPDATE PLAYER_MASTER SET player_name = %s WHERE player_id = %s", (name, pid))
-                conn.commit()
+            self._write([("UPDATE PLAYER_MASTER SET player_name = %s WHERE player_id = %s", (name, pid))])
             return True
-        except: return False
+        except UniqueViolation: return False
     def delete_player(self, pid):
-        with self._connect() as conn:
-            with conn.cursor() as c:
-                c.execute("DELETE FROM KARTY_DATA WHERE player_id = %s", (pid,))
-                c.execute("DELETE FROM PLAYER_MASTER WHERE player_id = %s", (pid,))
-            conn.commit()
+        self._write([("DELETE FROM KARTY_DATA WHERE player_id = %s", (pid,)),
+                     ("DELETE FROM PLAYER_MASTER WHERE player_id = %s", (pid,))])
 
-    def search_karty(self, filters):
-        query = "SELECT k.karte_id, k.date, p.player_name, k.tr, k.a_content, k.time_loss_category, k.diagnosis_flag, k.report_flag FROM KARTY_DATA k LEFT JOIN PLAYER_MASTER p ON k.player_id = p.player_id WHERE 1=1"
-        params = []
-        if filters.get('player_id'): query += " AND k.player_id = %s"; params.append(filters['player_id'])
-        if filters.get('start_date'): query += " AND k.date >= %s"; params.append(filters['start_date'])
-        if filters.get('end_date'): query += " AND k.date <= %s"; params.append(filters['end_date'])
-        if filters.get('time_loss_category'):
-            if filters['time_loss_category'] == 'TIME_LOSS_ONLY': query += " AND (k.time_loss_category = 'TIME LOSS' OR k.time_loss_category = 'RETURN TO PLAY')"
-            elif filters['time_loss_category'] != 'ALL': query += " AND k.time_loss_category = %s"; params.append(filters['time_loss_category'])
-        if filters.get('keyword'):
-            kw = f"%{filters['keyword']}%"
-            query += " AND (k.s_content LIKE %s OR k.o_content LIKE %s OR k.a_content LIKE %s OR k.p_content LIKE %s OR k.tr LIKE %s)"
-            params.extend([kw, kw, kw, kw, kw])
-        query += " ORDER BY k.date DESC"
-        return self._execute(query, params, fetch_all=True)
+    def search_karty(self, filters, page=1, per_page=50):
+        """絞り込み条件に一致するカルテ一覧を1ページ分取得し、(rows, 総件数) を返す"""
+        shape, params = [], []
+        for key in ('player_id', 'start_date', 'end_date'):
+            if filters.get(key): shape.append(key); params.append(filters[key])
+        tlc = filters.get('time_loss_category')
+        if tlc == 'TIME_LOSS_ONLY': shape.append('time_loss_only')
+        elif tlc and tlc != 'ALL': shape.append('time_loss_category'); params.append(tlc)
+        if filters.get('keyword'): shape.append('keyword'); params.append(f"%{filters['keyword']}%")
+        count_sql, list_sql = _search_sql(tuple(shape))
+        total = self._execute(count_sql, params)
+        rows = self._execute_json(list_sql, params + [per_page, (page - 1) * per_page])
+        self._attach_player_names(rows)
+        return rows, (total['total'] if total else 0)
 
     def create_karte(self, data: Dict):
-        cols = ', '.join(data.keys())
-        plds = ', '.join(['%s'] * len(data))
-        sql = f"INSERT INTO KARTY_DATA ({cols}) VALUES ({plds})"
+        values = [data[k] for k in KARTE_COLUMNS]
         with self._connect() as conn:
-            with conn.cursor() as c: c.execute(sql, self._sanitize_values(data))
-            conn.commit()
+            with conn.cursor() as c:
+                self._execute_prepared(c, 'karte_ins', values)
+                kid = c.fetchone()[0]
+        self._invalidate_cache()
+        return kid
 
     def update_karte(self, kid, data: Dict):
-        set_c = ', '.join([f"{key} = %s" for key in data.keys()])
-        sql = f"UPDATE KARTY_DATA SET {set_c} WHERE karte_id = %s"
+        values = [data[k] for k in KARTE_COLUMNS]
         with self._connect() as conn:
-            with conn.cursor() as c: c.execute(sql, self._sanitize_values(data) + [kid])
-            conn.commit()
+            with conn.cursor() as c: self._execute_prepared(c, 'karte_upd', values + [kid])
+        self._invalidate_cache()
 
-    def get_karte(self, kid): return self._execute("SELECT k.*, p.player_name FROM KARTY_DATA k LEFT JOIN PLAYER_MASTER p ON k.player_id=p.player_id WHERE k.karte_id = %s", (kid,))
-    def get_latest_karte_by_player(self, pid): return self._execute("SELECT * FROM KARTY_DATA WHERE player_id = %s ORDER BY date DESC, karte_id DESC LIMIT 1", (pid,))
+    def get_karte(self, kid):
+        karte = self._fetch_prepared('karte_get', [kid])
+        if karte: self._attach_player_names([karte])
+        return karte
+    def get_copy_source(self, kid=None, pid=None):
+        """コピー元カルテを1クエリで取得（karte_id 指定を優先、なければ選手の最新カルテ）"""
+        return self._execute("SELECT * FROM KARTY_DATA WHERE karte_id = COALESCE(%s, (SELECT karte_id FROM KARTY_DATA WHERE player_id = %s ORDER BY date DESC, karte_id DESC LIMIT 1))", (kid, pid))
     def delete_karte(self, kid):
         with self._connect() as conn:
-            with conn.cursor() as c: c.execute("DELETE FROM KARTY_DATA WHERE karte_id = %s", (kid,))
-            conn.commit()
+            with conn.cursor() as c: self._execute_prepared(c, 'karte_del', [kid])
+        self._invalidate_cache()
 
-    def get_all_time_loss_categories(self): return self._execute("SELECT time_loss_category, COUNT(karte_id) as count FROM KARTY_DATA WHERE time_loss_category IN ('TIME LOSS', 'NEW/RE-INJURY', 'RETURN TO PLAY') GROUP BY time_loss_category", fetch_all=True)
-    def get_injury_report_data(self): return self._execute("SELECT time_loss_category, injury_site, injury_type, COUNT(karte_id) as count FROM KARTY_DATA WHERE time_loss_category IN ('TIME LOSS', 'NEW/RE-INJURY', 'RETURN TO PLAY') GROUP BY time_loss_category, injury_site, injury_type HAVING injury_site IS NOT NULL AND injury_site != ''", fetch_all=True)
+    def get_all_time_loss_categories(self): return self._execute_cached("SELECT time_loss_category, COUNT(karte_id) as count FROM KARTY_DATA WHERE time_loss_category IN ('TIME LOSS', 'NEW/RE-INJURY', 'RETURN TO PLAY') GROUP BY time_loss_category", as_json=True)
+    def get_injury_report_data(self): return self._execute_cached("SELECT time_loss_category, injury_site, injury_type, COUNT(karte_id) as count FROM KARTY_DATA WHERE time_loss_category IN ('TIME LOSS', 'NEW/RE-INJURY', 'RETURN TO PLAY') GROUP BY time_loss_category, injury_site, injury_type HAVING injury_site IS NOT NULL AND injury_site != '' ORDER BY time_loss_category, count DESC", as_json=True)
+    def get_site_totals(self): return self._execute_cached("SELECT injury_site, COUNT(karte_id) as total FROM KARTY_DATA WHERE time_loss_category IN ('TIME LOSS', 'NEW/RE-INJURY', 'RETURN TO PLAY') AND injury_site IS NOT NULL AND injury_site != '' GROUP BY injury_site ORDER BY total DESC", fetch_all=True)
     def get_player_summary_data(self, pid):
-        return {
-            'stats': self._execute("SELECT COUNT(karte_id) as total_kartes FROM KARTY_DATA WHERE player_id = %s", (pid,)),
-            'time_loss_stats': self._execute("SELECT COUNT(CASE WHEN time_loss_category = 'TIME LOSS' THEN 1 END) as tl_count, COUNT(CASE WHEN time_loss_category = 'RETURN TO PLAY' THEN 1 END) as rtp_count FROM KARTY_DATA WHERE player_id = %s", (pid,)),
-            'history': self._execute("SELECT date, injury_site, injury_type, a_content, time_loss_category FROM KARTY_DATA WHERE player_id = %s ORDER BY date DESC LIMIT 10", (pid,), fetch_all=True)
-        }
-    def get_coach_reports(self): return self._execute("SELECT DISTINCT ON (k.player_id) k.*, p.player_name FROM KARTY_DATA k LEFT JOIN PLAYER_MASTER p ON k.player_id = p.player_id WHERE k.report_flag = 1 ORDER BY k.player_id, k.date DESC, k.karte_id DESC", fetch_all=True)
-    def get_latest_injury_date(self, pid, dt):
-        res = self._execute("SELECT date FROM KARTY_DATA WHERE player_id = %s AND time_loss_category = 'NEW/RE-INJURY' AND date <= %s ORDER BY date DESC LIMIT 1", (pid, dt))
-        return res['date'] if res else None
+        """件数集計と直近10件の履歴（json_agg）を1クエリで取得"""
+        row = self._execute("WITH base AS (SELECT karte_id, date, injury_site, injury_type, a_content, time_loss_category FROM KARTY_DATA WHERE player_id = %s) "
+                            "SELECT COUNT(karte_id) as total_kartes, COUNT(*) FILTER (WHERE time_loss_category = 'TIME LOSS') as tl_count, COUNT(*) FILTER (WHERE time_loss_category = 'RETURN TO PLAY') as rtp_count, "
+                            "(SELECT COALESCE(json_agg(h ORDER BY h.date DESC), '[]'::json) FROM (SELECT date, injury_site, injury_type, a_content, time_loss_category FROM base ORDER BY date DESC LIMIT 10) h) as history FROM base", (pid,))
+        history = row.pop('history') if row else []
+        return {'stats': row, 'time_loss_stats': row, 'history': history}
+    def get_coach_reports(self):
+        """選手ごとに報告フラグ付きの最新カルテを1件（idx_karty_report を選手単位で引く LATERAL 結合）"""
+        return self._execute_json("SELECT k.*, p.player_name FROM PLAYER_MASTER p JOIN LATERAL (SELECT * FROM KARTY_DATA WHERE player_id = p.player_id AND report_flag = 1 ORDER BY date DESC, karte_id DESC LIMIT 1) k ON true ORDER BY p.player_id")
+    def get_latest_injury_dates_bulk(self, pairs):
+        """(player_id, date) の組ごとの直近受傷日を1クエリでまとめて取得"""
+        if not pairs: return {}
+        pids, dates = zip(*pairs)
+        rows = self._execute("SELECT v.player_id, v.date, MAX(k.date) AS injury_date FROM unnest(%s::int[], %s::text[]) AS v(player_id, date) JOIN KARTY_DATA k ON k.player_id = v.player_id AND k.date <= v.date WHERE k.time_loss_category = 'NEW/RE-INJURY' GROUP BY v.player_id, v.date", (list(pids), list(dates)), fetch_all=True)
+        return {(r['player_id'], r['date']): r['injury_date'] for r in rows}
@@ -0,0 +1,13 @@
+"""
+Pirates Trainer App - Gunicorn Settings
+Loaded automatically by `gunicorn app:app`.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# 各ワーカーが最大 DB_POOL_MAX（>= threads）本の DB 接続を持つため、workers × DB_POOL_MAX が DB の max_connections に収まること。
+# コンテナ内の cpu_count() はホストの CPU 数を返すことがあるので、本番では WEB_CONCURRENCY を明示する
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))